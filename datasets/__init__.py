@@ -30,10 +30,15 @@ dataset_list = {
                 }
 
 
+# Datasets whose constructor takes more than (root_path, shots)
+dataset_builders = {
+                "imagenet": lambda root_path, shots, preprocess, breaking_loss: ImageNet(root_path, shots, preprocess),
+                "circuits": lambda root_path, shots, preprocess, breaking_loss: Circuits(root_path, shots, breaking_loss),
+                }
+
+
 def build_dataset(dataset, root_path, shots, preprocess, breaking_loss):
-    if dataset == 'imagenet':
-        return dataset_list[dataset](root_path, shots, preprocess)
-    elif dataset == 'circuits':
-        return dataset_list[dataset](root_path, shots, breaking_loss)
-    else:
-        return dataset_list[dataset](root_path, shots)
\ No newline at end of file
+    builder = dataset_builders.get(dataset)
+    if builder is None:
+        return dataset_list[dataset](root_path, shots)
+    return builder(root_path, shots, preprocess, breaking_loss)
\ No newline at end of file
@@ -406,7 +406,8 @@ def build_data_loader(
     shuffle=False,
     dataset_wrapper=None,
     num_workers=8,
-    task_type='image2text'
+    task_type='image2text',
+    drop_last=False
 ):
 
     if dataset_wrapper is None:
@@ -419,8 +420,11 @@ def build_data_loader(
         batch_size=batch_size,
         num_workers=num_workers,
         shuffle=shuffle,
-        drop_last=False,
-        pin_memory=(torch.cuda.is_available())
+        drop_last=drop_last,
+        pin_memory=(torch.cuda.is_available()),
+        # keep workers alive across epochs / evaluations instead of respawning them on every new iterator
+        persistent_workers=(num_workers > 0),
+        prefetch_factor=(4 if num_workers > 0 else None)
     )
     assert len(data_loader) > 0
 
@@ -1,5 +1,9 @@
+import os
+import hashlib
+import pickle
+import functools
+import threading
 import pandas as pd
-import umap
 import matplotlib.pyplot as plt
 import numpy as np
 import json
@@ -8,9 +12,18 @@ import seaborn as sns
 from PIL import Image
 import torchvision.transforms as transforms
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
-from skimage.transform import resize
-from sklearn.metrics import silhouette_score, adjusted_rand_score, homogeneity_score, completeness_score, v_measure_score
+from sklearn.metrics import pairwise_distances_chunked, mutual_info_score
+from sklearn.metrics.cluster import contingency_matrix
 from matplotlib.gridspec import GridSpec
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Memory
+# Attention maps are upsampled with OpenCV when available, PIL otherwise
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 METRICS = True
 UMAP_PLOT = True
@@ -22,25 +35,70 @@ FAILURES_PLOT = True
 DATASET = 'eurosat'
 JSON = 'eurosat'
 
+# Parsed CSV arrays are cached here as .npy files
+CACHE_DIR = 'cache'
+CACHED_ARRAYS = ('features', 'similarities', 'targets', 'predictions')
+# Fitted UMAP embeddings are cached by joblib under CACHE_DIR/umap
+UMAP_CACHE_DIR = os.path.join(CACHE_DIR, 'umap')
+
 """
 GET DATA FUNCTIONS
 """
+def get_cache_prefix(csv_filename):
+    """
+    Build the .npy cache prefix of a CSV file, keyed by its name and modification time
+    so that a rewritten CSV invalidates the cache.
+    """
+    stat = os.stat(csv_filename)
+    key = hashlib.md5(f"{os.path.abspath(csv_filename)}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(csv_filename))[0]
+    return os.path.join(CACHE_DIR, f"{name}_{key}")
+
+def parse_array_column(column, dtype=np.float32):
+    """
+    Parse a CSV column of "[x1, x2, ...]" strings into a (N, D) array.
+    Brackets are stripped and the whole column is tokenized by a single np.fromstring call.
+    """
+    flat = np.fromstring(','.join(column.str.slice(1, -1)), sep=',', dtype=dtype)
+    return flat.reshape(len(column), -1)
+
 # 'results/results_csv/zero_shot_'+DATASET+'.csv'
 def get_data(csv_filename='results/results_csv/evaluation_results.csv', json_label_map='data/'+JSON+'/label_map.json'):
     # Open and read the JSON file
     with open(json_label_map, 'r') as file:
         label_map = json.load(file)
 
-    # Load the CSV file using pandas
-    df = pd.read_csv(csv_filename)
-    # Extract features and targets from the dataframe
-    features = np.array(df['features'].apply(lambda x: np.fromstring(x[1:-1], sep=',')).tolist())  # Convert string to list of numbers
-    similarities = np.array(df['similarity'].apply(lambda x: np.fromstring(x[1:-1], sep=',')).tolist())  # Convert string to list of numbers
-    targets = np.array(df['target'])
-    predictions = np.array(df['prediction'])
-    
-    # Map numeric labels to their corresponding string labels
-    string_targets = np.array([label_map[str(target)] for target in targets])
+    # Load parsed arrays from the .npy cache if this exact CSV was already converted
+    prefix = get_cache_prefix(csv_filename)
+    cache_paths = [f"{prefix}_{name}.npy" for name in CACHED_ARRAYS]
+    if all(os.path.exists(path) for path in cache_paths):
+        features, similarities, targets, predictions = (np.load(path, mmap_mode='r') for path in cache_paths)
+    else:
+        # Load the CSV file using pandas
+        df = pd.read_csv(csv_filename)
+        # Extract features and targets from the dataframe
+        features = parse_array_column(df['features'])
+        similarities = parse_array_column(df['similarity'])
+        targets = df['target'].to_numpy(dtype=np.int32)
+        predictions = df['prediction'].to_numpy(dtype=np.int32)
+        # Write the cache so that the next runs skip the CSV parsing
+        # (each file is written to a temporary path and renamed, so an interrupted run never leaves a truncated .npy)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for path, array in zip(cache_paths, (features, similarities, targets, predictions)):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                np.save(file, array)
+            os.replace(tmp_path, path)
+
+    # Distance-heavy work (UMAP, silhouette) runs on float32 features and int32 labels
+    features = features.astype(np.float32, copy=False)
+    similarities = similarities.astype(np.float32, copy=False)
+    targets = targets.astype(np.int32, copy=False)
+    predictions = predictions.astype(np.int32, copy=False)
+
+    # Map numeric labels to their corresponding string labels with a single gather over an id -> name array
+    label_names = np.array([label_map[str(i)] for i in range(len(label_map))])
+    string_targets = np.take(label_names, targets)
     
     return features, targets, predictions, similarities, string_targets, label_map
 
@@ -48,103 +106,254 @@ def get_data(csv_filename='results/results_csv/evaluation_results.csv', json_lab
 METRICS COMPUTATION FUNCTIONS
 """
 
-def compute_silhouette_scores(embeddings, targets, predictions):
+def silhouette_reduce(D_chunk, start, labels, label_freqs, one_hot):
+    """
+    Reduce a row-block of the distance matrix to the per-sample silhouette terms:
+    mean distance to the own cluster (a) and to the nearest other cluster (b).
+    """
+    rows = np.arange(D_chunk.shape[0])
+    chunk_labels = labels[start:start + D_chunk.shape[0]]
+    # Sum of the distances from each sample of the chunk to every cluster, as one GEMM
+    cluster_distances = D_chunk @ one_hot
+    intra = cluster_distances[rows, chunk_labels] / np.maximum(label_freqs[chunk_labels] - 1, 1)
+    cluster_distances[rows, chunk_labels] = np.inf
+    inter = (cluster_distances / label_freqs).min(axis=1)
+    return intra, inter
+
+def compute_silhouette(embeddings, labels, working_memory=512, sample_size=None, random_state=0):
+    """
+    Mean silhouette coefficient, computed over row-blocks of the pairwise distance matrix
+    so that the full N x N matrix is never allocated.
+    If sample_size is given and smaller than N, it is computed on a random subsample of that size.
+    """
+    if sample_size is not None and len(labels) > sample_size:
+        sample = np.random.default_rng(random_state).permutation(len(labels))[:sample_size]
+        embeddings, labels = embeddings[sample], labels[sample]
+    _, labels = np.unique(labels, return_inverse=True)
+    label_freqs = np.bincount(labels)
+    if not 2 <= len(label_freqs) <= len(labels) - 1:
+        raise ValueError(f"Number of labels is {len(label_freqs)}. Valid values are 2 to n_samples - 1 (inclusive)")
+    one_hot = np.eye(len(label_freqs), dtype=embeddings.dtype)[labels]
+
+    reduce_func = functools.partial(silhouette_reduce, labels=labels, label_freqs=label_freqs, one_hot=one_hot)
+    chunks = pairwise_distances_chunked(embeddings, reduce_func=reduce_func, metric='euclidean', working_memory=working_memory, n_jobs=-1)
+    intra, inter = (np.concatenate(values) for values in zip(*chunks))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        silhouette = np.nan_to_num((inter - intra) / np.maximum(intra, inter))
+    # Samples alone in their cluster have a silhouette of 0
+    silhouette[label_freqs[labels] == 1] = 0
+    return float(np.mean(silhouette))
+
+def compute_silhouette_scores(embeddings, targets, predictions, sample_size=10_000):
     # Silhouette score is a measure of how similar an object is to its own cluster compared to other clusters.
-    silhouette_complete = silhouette_score(embeddings, targets, metric='euclidean')
+    # It is O(N^2), so sets larger than sample_size are subsampled (sample_size=None for the exact value).
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    silhouette_complete = compute_silhouette(embeddings, targets, sample_size=sample_size)
     correct_indices = targets == predictions
-    silhouette_correct = silhouette_score(embeddings[correct_indices], targets[correct_indices], metric='euclidean') if np.sum(correct_indices) > 0 else None
+    silhouette_correct = compute_silhouette(embeddings[correct_indices], targets[correct_indices], sample_size=sample_size) if np.sum(correct_indices) > 0 else None
     wrong_indices = ~correct_indices
-    silhouette_wrong = silhouette_score(embeddings[wrong_indices], targets[wrong_indices], metric='euclidean') if np.sum(wrong_indices) > 0 else None
+    silhouette_wrong = compute_silhouette(embeddings[wrong_indices], targets[wrong_indices], sample_size=sample_size) if np.sum(wrong_indices) > 0 else None
 
     return silhouette_complete, silhouette_correct, silhouette_wrong
 
-def compute_ari(true_labels, predicted_labels):
+def compute_all_cluster_metrics(true_labels, predicted_labels):
+    """
+    ARI, homogeneity, completeness and V-measure derived from a single contingency table,
+    instead of letting each sklearn score rebuild it.
+    """
+    contingency = contingency_matrix(true_labels, predicted_labels, sparse=True)
+    n_samples = len(true_labels)
+    class_counts = np.ravel(contingency.sum(axis=1))
+    cluster_counts = np.ravel(contingency.sum(axis=0))
+
     # ARI is a measure of the similarity between cluster assignments.
     # It's robust to cluster imbalance.
-    ari = adjusted_rand_score(true_labels, predicted_labels)
-    return ari
-
-def compute_clustering_metrics(true_labels, predicted_labels):
+    sum_comb = np.sum(contingency.data * (contingency.data - 1) / 2)
+    sum_comb_classes = np.sum(class_counts * (class_counts - 1) / 2)
+    sum_comb_clusters = np.sum(cluster_counts * (cluster_counts - 1) / 2)
+    expected_index = sum_comb_classes * sum_comb_clusters / (n_samples * (n_samples - 1) / 2)
+    max_index = (sum_comb_classes + sum_comb_clusters) / 2
+    ari = 1.0 if max_index == expected_index else (sum_comb - expected_index) / (max_index - expected_index)
+
+    # Entropies of the ground truth classes and of the predicted clusters
+    entropy_classes = -np.sum(class_counts / n_samples * np.log(class_counts / n_samples))
+    entropy_clusters = -np.sum(cluster_counts / n_samples * np.log(cluster_counts / n_samples))
+    mutual_info = mutual_info_score(None, None, contingency=contingency)
     # Measures whether each cluster contains only data points that are members of a single ground truth class.
     # It's a synonym of cluster "purity".
     # "Are the clusters pure with respect to the ground truth?"
-    homogeneity = homogeneity_score(true_labels, predicted_labels)
+    homogeneity = mutual_info / entropy_classes if entropy_classes else 1.0
     # Ensures that all data points from a single ground truth class are assigned to the same predicted cluster.
     # "Are all points in a ground truth class assigned to the same cluster?"
-    completeness = completeness_score(true_labels, predicted_labels)
+    completeness = mutual_info / entropy_clusters if entropy_clusters else 1.0
     # Harmonic mean of homogeneity and completeness.
-    v_measure = v_measure_score(true_labels, predicted_labels)
-    return homogeneity, completeness, v_measure
+    v_measure = 2 * homogeneity * completeness / (homogeneity + completeness) if homogeneity + completeness else 0.0
+    return ari, homogeneity, completeness, v_measure
 
 def compute_class_accuracy(targets, predictions, string_targets):
-    class_metrics = []
-    unique_classes = np.unique(targets)
-    
-    for cls in unique_classes:
-        class_indices = targets == cls
-        total_class_count = np.sum(class_indices)
-        
-        correct_class_count = np.sum(class_indices & (targets == predictions))  # Correct predictions
-        wrong_class_count = total_class_count - correct_class_count  # Wrong predictions
-        
-        accuracy = correct_class_count / total_class_count if total_class_count > 0 else 0
-        
-        class_name = string_targets[class_indices][0]  # Assuming all class indices map to the same string name
-        
-        class_metrics.append([class_name, correct_class_count, wrong_class_count, total_class_count, accuracy])
-
-    class_accuracy_df = pd.DataFrame(class_metrics, columns=["Class", "+", "-", "Total", "Accuracy"])
+    # Per-class counts in a single bincount pass over the samples
+    total_class_count = np.bincount(targets)
+    correct_class_count = np.bincount(targets, weights=(targets == predictions)).astype(np.int64)  # Correct predictions
+    wrong_class_count = total_class_count - correct_class_count  # Wrong predictions
+
+    # All samples of a class share the same string name
+    class_names = np.empty(len(total_class_count), dtype=object)
+    class_names[targets] = string_targets
+
+    # Keep only the classes that appear in targets
+    present = np.nonzero(total_class_count)[0]
+    class_accuracy_df = pd.DataFrame({
+        "Class": class_names[present],
+        "+": correct_class_count[present],
+        "-": wrong_class_count[present],
+        "Total": total_class_count[present],
+        "Accuracy": correct_class_count[present] / total_class_count[present],
+    })
     return class_accuracy_df
 
 """
 PLOTTING FUNCTIONS
 """
 
+def get_display_range(images, n_samples=256, seed=0):
+    """
+    Global (min, max) used to normalize images for display, estimated on a random subsample
+    so that every plotted image shares the same scale without a pass over the whole set.
+    """
+    rng = np.random.default_rng(seed)
+    sample = images[np.sort(rng.choice(len(images), size=min(n_samples, len(images)), replace=False))]
+    return float(sample.min()), float(sample.max())
+
+def prepare_display_image(image, value_range):
+    """
+    Convert a (C, H, W) image to (H, W, C) and scale it to [0, 1] with the given (min, max).
+    """
+    low, high = value_range
+    image = np.transpose(image, (1, 2, 0)).astype(np.float32)
+    return np.clip((image - low) / (high - low), 0, 1)
+
+def resize_heatmap(heatmap, height, width):
+    """
+    Bicubic upsampling of a 2D attention heatmap to (height, width).
+    The output is clipped to the input range (bicubic overshoots), as skimage's resize does by default.
+    """
+    heatmap = np.asarray(heatmap, dtype=np.float32)
+    if cv2 is not None:
+        out = cv2.resize(heatmap, (width, height), interpolation=cv2.INTER_CUBIC)
+    else:
+        out = np.asarray(Image.fromarray(heatmap).resize((width, height), Image.BICUBIC))
+    return np.clip(out, heatmap.min(), heatmap.max())
+
+def get_top_k_order(values, k):
+    """
+    Indices of the k largest values in ascending order, same as np.argsort(values)[-k:].
+    The k entries are selected with np.argpartition in O(M) and only those are sorted.
+    """
+    if len(values) <= k:
+        return np.argsort(values)
+    top_k = np.argpartition(values, -k)[-k:]
+    return top_k[np.argsort(values[top_k])]
+
+def get_knn_graph(features, n_neighbors=15):
+    """
+    Build the NN-descent KNN graph of the features, or load it from the cache.
+    The cache is keyed by a hash of the feature values, so reruns on the same data skip the NN search.
+
+    Returns:
+    - knn_indices (np.array): (N, n_neighbors) neighbor indices
+    - knn_dists (np.array): (N, n_neighbors) neighbor distances
+    """
+    key = hashlib.md5(np.ascontiguousarray(features).tobytes()).hexdigest()[:16]
+    cache_path = os.path.join(CACHE_DIR, f"knn_{n_neighbors}_{key}.pkl")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as file:
+            return pickle.load(file)
+
+    from pynndescent import NNDescent
+    index = NNDescent(features, n_neighbors=n_neighbors, metric='euclidean', n_jobs=-1, low_memory=False)
+    knn_graph = index.neighbor_graph
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, 'wb') as file:
+        pickle.dump(knn_graph, file)
+    return knn_graph
+
+@functools.lru_cache(maxsize=None)
+def get_cached_umap_fit():
+    """
+    Wrap compute_umap_embedding in a joblib disk cache. The Memory (and its cache directory) is only
+    created on the first UMAP fit, not when this module is imported.
+    """
+    return Memory(UMAP_CACHE_DIR, verbose=0).cache(compute_umap_embedding)
+
+def fit_umap(features, n_neighbors=15, min_dist=0.1):
+    """
+    Fit UMAP on the features and return the 2D embedding.
+    Results are cached on disk by joblib, keyed by the feature values and the arguments.
+    """
+    return get_cached_umap_fit()(features, n_neighbors=n_neighbors, min_dist=min_dist)
+
+def compute_umap_embedding(features, n_neighbors=15, min_dist=0.1):
+    """
+    Uncached UMAP fit.
+    Uses the GPU UMAP from RAPIDS cuML when available, umap-learn on CPU otherwise. Both are imported here,
+    so importing this module (e.g. from main.py) does not load RAPIDS or create its CUDA context.
+    """
+    try:
+        import cupy
+        from cuml.manifold import UMAP
+        use_cuml = torch.cuda.is_available()
+    except ImportError:
+        use_cuml = False
+    if use_cuml:
+        umap_model = UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric='euclidean')
+        return cupy.asnumpy(umap_model.fit_transform(cupy.asarray(features, dtype=np.float32)))
+    from umap import UMAP
+    knn_indices, knn_dists = get_knn_graph(features, n_neighbors=n_neighbors)
+    umap_model = UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric='euclidean', precomputed_knn=(knn_indices, knn_dists, None),
+                      n_jobs=-1, low_memory=False, verbose=False)
+    return umap_model.fit_transform(features)
+
 def plot_umap(features, targets, predictions, string_targets, output_filename='umap_plot.png'):
-    umap_model = umap.UMAP(n_neighbors=15, min_dist=0.1, metric='euclidean')
-    umap_embeddings = umap_model.fit_transform(features)
+    features = np.asarray(features, dtype=np.float32)
+    umap_embeddings = fit_umap(features, n_neighbors=15, min_dist=0.1)
 
     x_min, x_max = umap_embeddings[:, 0].min() - 0.1, umap_embeddings[:, 0].max() + 0.1
     y_min, y_max = umap_embeddings[:, 1].min() - 0.1, umap_embeddings[:, 1].max() + 0.1
 
-    unique_targets = np.unique(string_targets)
+    unique_targets, target_ids = np.unique(string_targets, return_inverse=True)
     vibrant_colors = sns.color_palette("hls", n_colors=len(unique_targets))
-    color_map = {target: vibrant_colors[i] for i, target in enumerate(unique_targets)}
+    # (N, 4) RGBA colors gathered from a per-class palette
+    palette = np.asarray(vibrant_colors, dtype=np.float32)
+    point_colors = np.concatenate((palette[target_ids], np.ones((len(target_ids), 1), dtype=np.float32)), axis=1)
 
     fig, axes = plt.subplots(2, 2, figsize=(14, 12))
 
     axes[0, 0].scatter(umap_embeddings[:, 0], umap_embeddings[:, 1], 
-                       c=[color_map[string_targets[i]] for i in range(len(targets))], s=12)
+                       c=point_colors, s=12, rasterized=True)
     axes[0, 0].set_title('Complete Set', fontsize=14)
     axes[0, 0].set_xlim(x_min, x_max)
     axes[0, 0].set_ylim(y_min, y_max)
 
     correct_indices = targets == predictions
-    point_colors = []
-    for i in range(len(targets)):
-        if correct_indices[i]:
-            color = np.array(color_map[string_targets[i]])
-            color = np.concatenate((color, [1.0]))  # Full opacity
-        else:
-            color = np.array(color_map[string_targets[i]])
-            color = np.concatenate((color, [0.3]))  # Add alpha for transparency
-        point_colors.append(color)
+    merged_colors = point_colors.copy()
+    merged_colors[~correct_indices, 3] = 0.3  # Add alpha for transparency
 
     axes[0, 1].scatter(umap_embeddings[:, 0], umap_embeddings[:, 1], 
-                       c=point_colors, s=12)
+                       c=merged_colors, s=12, rasterized=True)
     axes[0, 1].set_title('Merged Prediction (Wrongs in Transparent)', fontsize=14)
     axes[0, 1].set_xlim(x_min, x_max)
     axes[0, 1].set_ylim(y_min, y_max)
 
     axes[1, 0].scatter(umap_embeddings[correct_indices, 0], umap_embeddings[correct_indices, 1], 
-                       c=[color_map[string_targets[i]] for i in range(len(targets)) if correct_indices[i]], s=12)
+                       c=point_colors[correct_indices], s=12, rasterized=True)
     axes[1, 0].set_title('Correct Predictions', fontsize=14)
     axes[1, 0].set_xlim(x_min, x_max)
     axes[1, 0].set_ylim(y_min, y_max)
 
     wrong_indices = ~correct_indices
     axes[1, 1].scatter(umap_embeddings[wrong_indices, 0], umap_embeddings[wrong_indices, 1], 
-                       c=[color_map[string_targets[i]] for i in range(len(targets)) if wrong_indices[i]], s=12)
+                       c=point_colors[wrong_indices], s=12, rasterized=True)
     axes[1, 1].set_title('Wrong Predictions', fontsize=14)
     axes[1, 1].set_xlim(x_min, x_max)
     axes[1, 1].set_ylim(y_min, y_max)
@@ -242,9 +451,8 @@ def plot_topk_images_for_class(
 
     assert mode in {"correct", "incorrect"}, "Mode must be 'correct' or 'incorrect'."
 
-    # Convert images from (N, C, H, W) to (N, H, W, C) and normalize for display
-    images_display = np.transpose(images, (0, 2, 3, 1))
-    images_display = (images_display - images_display.min()) / (images_display.max() - images_display.min())
+    # Images are converted to (H, W, C) and normalized lazily, only for the displayed ones
+    value_range = get_display_range(images)
 
     # Determine mask and title based on mode
     if mode == "correct":
@@ -288,10 +496,15 @@ def plot_topk_images_for_class(
         if mode == "correct":
             class_similarities = similarities[class_indices, class_idx]
         else:
-            class_similarities = np.array([similarities[idx, predictions[idx]] for idx in class_indices])
+            class_similarities = similarities[class_indices, predictions[class_indices]]
+
+        top_k_order = get_top_k_order(class_similarities, k)
+        top_k_indices = class_indices[top_k_order]
+        top_k_similarities = class_similarities[top_k_order]
 
-        top_k_indices = class_indices[np.argsort(class_similarities)[-k:]]
-        top_k_similarities = class_similarities[np.argsort(class_similarities)[-k:]]
+        # Attention maps of the displayed images in a single forward pass
+        attention_maps, salient_masks = plot_attention_map_enhance_batch(
+            [dataset[idx].impath for idx in top_k_indices], preprocess, model, top_k_indices, num_workers=0, plot=False)
 
         # Plot top k images and their attention maps
         for j in range(k):
@@ -305,20 +518,21 @@ def plot_topk_images_for_class(
                     subtitle = f"Pred: {classnames[pred_class]}\nSim: {sim:.3f}"
 
                 # Plot original image
+                image_display = prepare_display_image(images[idx], value_range)
                 ax_img = fig.add_subplot(gs[current_row, j + 1])
-                ax_img.imshow(images_display[idx])
+                ax_img.imshow(image_display)
                 ax_img.axis('off')
                 ax_img.set_title(subtitle, size=10, pad=5)
 
                 # Plot attention map on the row below
-                attention, salient = plot_attention_map_enhance(dataset[idx].impath, preprocess, model, idx, False)
-                h, w = images_display[idx].shape[:2]
+                attention, salient = attention_maps[-(j+1)], salient_masks[-(j+1)]
+                h, w = image_display.shape[:2]
                 salient_heatmap = np.zeros_like(attention)
                 salient_heatmap[salient] = attention[salient]
-                salient_heatmap_resized = resize(salient_heatmap, (h, w), order=3, mode='constant')
+                salient_heatmap_resized = resize_heatmap(salient_heatmap, h, w)
 
                 ax_attn = fig.add_subplot(gs[current_row + 1, j + 1])
-                ax_attn.imshow(images_display[idx])
+                ax_attn.imshow(image_display)
                 ax_attn.imshow(salient_heatmap_resized, alpha=0.3, cmap='jet')
                 ax_attn.axis('off')
 
@@ -352,9 +566,8 @@ def plot_topk_images(images, targets, predictions, similarities, classnames, k=5
 
     assert mode in {"correct", "incorrect"}, "Mode must be 'correct' or 'incorrect'."
 
-    # Convert images from (N, C, H, W) to (N, H, W, C) and normalize for display
-    images_display = np.transpose(images, (0, 2, 3, 1))
-    images_display = (images_display - images_display.min()) / (images_display.max() - images_display.min())
+    # Images are converted to (H, W, C) and normalized lazily, only for the displayed ones
+    value_range = get_display_range(images)
 
     if mode == "correct":
         # Get correctly classified samples
@@ -365,16 +578,15 @@ def plot_topk_images(images, targets, predictions, similarities, classnames, k=5
         # Get misclassified samples
         mask = targets != predictions
         title = "Top Worst Misclassified Images by Cosine Similarity"
-        similarity_values = np.array([similarities[idx, predictions[idx]] for idx in range(len(predictions))])
+        similarity_values = similarities[np.arange(len(similarities)), predictions]
 
     indices = np.where(mask)[0]
     if len(indices) == 0:
         print(f"No {'correct' if mode == 'correct' else 'incorrect'} samples to display.")
         return
 
-    # Sort indices by similarity
-    sorted_indices = indices[np.argsort(similarity_values[indices])]
-    top_k_indices = sorted_indices[-k:]  # Top k
+    # Select the top k indices by similarity
+    top_k_indices = indices[get_top_k_order(similarity_values[indices], k)]
     top_k_indices = top_k_indices[::-1]  # Reverse for descending order
 
     # Create figure with space for original images and attention maps
@@ -382,27 +594,31 @@ def plot_topk_images(images, targets, predictions, similarities, classnames, k=5
     n_rows = 2  # One row for original images, one for attention maps
     fig, axes = plt.subplots(n_rows, n_cols, figsize=(4 * n_cols, 8))
 
+    # Attention maps of the displayed images in a single forward pass
+    attention_maps, salient_masks = plot_attention_map_enhance_batch(
+        [dataset[idx].impath for idx in top_k_indices], preprocess, model, top_k_indices, num_workers=0, plot=False)
+
     for i, idx in enumerate(top_k_indices):
         sim = similarity_values[idx]
         label_text = (f"Class: {classnames[targets[idx]]}\n"
                       f"Pred: {classnames[predictions[idx]] if mode == 'incorrect' else 'Correct'}\n"
                       f"Sim: {sim:.3f}")
         
-        # Compute attention map
-        attention, salient = plot_attention_map_enhance(dataset[idx].impath, preprocess, model, idx, False)
+        attention, salient = attention_maps[i], salient_masks[i]
 
         # Original image
-        axes[0, i].imshow(images_display[idx])
+        image_display = prepare_display_image(images[idx], value_range)
+        axes[0, i].imshow(image_display)
         axes[0, i].axis('off')
         axes[0, i].set_title(label_text, fontsize=12, pad=5)
 
         # Attention map
-        h, w = images_display[idx].shape[:2]
+        h, w = image_display.shape[:2]
         salient_heatmap = np.zeros_like(attention)
         salient_heatmap[salient] = attention[salient]
-        salient_heatmap_resized = resize(salient_heatmap, (h, w), order=3, mode='constant')
+        salient_heatmap_resized = resize_heatmap(salient_heatmap, h, w)
 
-        axes[1, i].imshow(images_display[idx])
+        axes[1, i].imshow(image_display)
         axes[1, i].imshow(salient_heatmap_resized, alpha=0.3, cmap='jet')
         axes[1, i].axis('off')
 
@@ -412,14 +628,81 @@ def plot_topk_images(images, targets, predictions, similarities, classnames, k=5
     plt.show()
 
 
-def plot_attention_map_enhance(impath, preprocess, model, name, plot=True):
-    # Transformation to match CLIP model's input requirements
-    transform_image = transforms.Compose([
-        transforms.Resize(model.visual.input_resolution, interpolation=Image.BICUBIC),
-        transforms.CenterCrop(model.visual.input_resolution),
-        lambda image: image.convert("RGB"),
-    ])
+def get_salient_attention(attention_map):
+    """
+    Normalize a (14, 14) attention map to [0, 1] and threshold it to its most salient regions.
+    """
+    attention_map = (attention_map - attention_map.min()) / (attention_map.max() - attention_map.min())
+
+    # Create a heatmap with a threshold to highlight most salient regions
+    threshold = np.percentile(attention_map, 50)  # Adjust this percentile as needed
+    salient_mask = attention_map >= threshold
+    return attention_map, salient_mask
 
+
+class AttentionMapPlotter:
+    """
+    Persistent figure saving an image next to its salient attention overlay.
+    The Artist tree is built on the first call, later calls only swap the image data before saving.
+    Rendered on an Agg canvas without pyplot, so each thread can own one plotter.
+    """
+    def __init__(self, input_resolution):
+        self.input_resolution = input_resolution
+        # Transformation to match CLIP model's input requirements
+        self.transform_image = transforms.Compose([
+            transforms.Resize(input_resolution, interpolation=Image.BICUBIC),
+            transforms.CenterCrop(input_resolution),
+            lambda image: image.convert("RGB"),
+        ])
+        self.cmap = plt.colormaps['jet']  # You can change 'jet' to other colormaps like 'viridis', 'plasma', etc.
+
+        # Create figure
+        self.fig = Figure(figsize=[10, 5])
+        FigureCanvasAgg(self.fig)
+        self.ax_img = self.fig.add_subplot(1, 2, 1)
+        self.ax_img.set_title('Original Image')
+        self.ax_img.axis('off')
+        self.ax_overlay = self.fig.add_subplot(1, 2, 2)
+        self.ax_overlay.set_title('Attention Map Overlay')
+        self.ax_overlay.axis('off')
+        self.image_handles = None
+
+    def __call__(self, img, attention_map, salient_mask, name):
+        original_img = np.asarray(self.transform_image(img))
+
+        # Overlay salient attention map
+        salient_heatmap = np.zeros_like(attention_map)
+        salient_heatmap[salient_mask] = attention_map[salient_mask]
+        # Resize attention map to match image dimensions and color the most salient regions
+        overlay = self.cmap(resize_heatmap(salient_heatmap, original_img.shape[0], original_img.shape[1]))
+
+        if self.image_handles is None:
+            self.image_handles = (self.ax_img.imshow(original_img),
+                                  self.ax_overlay.imshow(original_img),
+                                  self.ax_overlay.imshow(overlay, alpha=0.3))
+            self.fig.tight_layout()
+        else:
+            for handle, data in zip(self.image_handles, (original_img, original_img, overlay)):
+                handle.set_data(data)
+        self.fig.savefig(f"{name}_attention.png", bbox_inches='tight', pad_inches=0)
+
+
+# One AttentionMapPlotter per thread, matplotlib figures must not be shared across threads
+attention_plotters = threading.local()
+
+def save_attention_map(img, attention_map, salient_mask, input_resolution, name):
+    """
+    Save the original image next to its salient attention overlay as {name}_attention.png,
+    reusing the AttentionMapPlotter of the calling thread.
+    """
+    plotter = getattr(attention_plotters, 'plotter', None)
+    if plotter is None or plotter.input_resolution != input_resolution:
+        plotter = AttentionMapPlotter(input_resolution)
+        attention_plotters.plotter = plotter
+    plotter(img, attention_map, salient_mask, name)
+
+
+def plot_attention_map_enhance(impath, preprocess, model, name, plot=True):
     # Open and preprocess the image
     img = Image.open(impath)
     img_input = preprocess(img).unsqueeze(0).cuda()
@@ -428,51 +711,84 @@ def plot_attention_map_enhance(impath, preprocess, model, name, plot=True):
     with torch.no_grad(): 
         with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
             image_attention = model.encode_image_attention(img_input)
-        attention_map = image_attention[0].reshape(14, 14).cpu().numpy()
-
-    # Normalize attention map
-    attention_map = (attention_map - attention_map.min()) / (attention_map.max() - attention_map.min())
+        attention_map = image_attention[0].reshape(14, 14).float().cpu().numpy()
 
-    # Create a heatmap with a threshold to highlight most salient regions
-    threshold = np.percentile(attention_map, 50)  # Adjust this percentile as needed
-    salient_mask = attention_map >= threshold
+    attention_map, salient_mask = get_salient_attention(attention_map)
     
     if plot:
-    # Create figure
-        fig = plt.figure(figsize=[10, 5])
-        ax = fig.add_subplot(1, 2, 1)
-        
-        # Original image
-        original_img = transform_image(img)
-        ax.imshow(original_img)
-        ax.set_title('Original Image')
-        ax.axis('off')
-        
-        ax = fig.add_subplot(1, 2, 2)
-        ax.set_title('Attention Map Overlay')
-        ax.imshow(original_img)
-
-        # Overlay salient attention map
-        cmap = plt.cm.get_cmap('jet')  # You can change 'jet' to other colormaps like 'viridis', 'plasma', etc.
-        salient_heatmap = np.zeros_like(attention_map)
-        salient_heatmap[salient_mask] = attention_map[salient_mask]
-        
-        # Resize attention map to match image dimensions
-        
-        salient_heatmap_resized = resize(salient_heatmap, (original_img.height, original_img.width), 
-                                        order=3, mode='constant')
-        
-        # Color the most salient regions
-        ax.imshow(cmap(salient_heatmap_resized), alpha=0.3, cmap=cmap)
-        
-        ax.axis('off')
-        plt.tight_layout()
-        plt.savefig(f"{name}_attention.png", bbox_inches='tight', pad_inches=0)
-        plt.close()
+        save_attention_map(img, attention_map, salient_mask, model.visual.input_resolution, name)
     return attention_map, salient_mask
 
 
+class ImagePathDataset(torch.utils.data.Dataset):
+    """
+    Read and preprocess images from a list of paths, for batched attention maps.
+    """
+    def __init__(self, impaths, preprocess):
+        self.impaths = impaths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.impaths)
+
+    def __getitem__(self, idx):
+        return self.preprocess(Image.open(self.impaths[idx]))
+
+
+def plot_attention_map_enhance_batch(impaths, preprocess, model, names, batch_size=64, num_workers=4, plot=True):
+    """
+    Batched version of plot_attention_map_enhance.
+    Images are preprocessed by a pinned-memory DataLoader and go through the vision encoder in batches,
+    while the PNGs of the previous batch are written by a thread pool.
+
+    Args:
+        impaths (list): Image paths
+        preprocess: Preprocessing function for the model
+        model: Model used for generating attention maps
+        names (list): Output name of each image ({name}_attention.png)
+        batch_size (int): Number of images per forward pass
+        num_workers (int): DataLoader workers used for preprocessing
+        plot (bool): Save the attention overlays
+
+    Returns:
+    - attention_maps (list): Normalized (14, 14) attention maps
+    - salient_masks (list): Boolean masks of the salient regions
+    """
+    loader = torch.utils.data.DataLoader(ImagePathDataset(impaths, preprocess), batch_size=batch_size, shuffle=False,
+                                         num_workers=num_workers, pin_memory=torch.cuda.is_available())
+    attention_maps, salient_masks = [], []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = []
+        for images in loader:
+            images = images.to('cuda', non_blocking=True)
+            # Get attention maps of the whole batch
+            with torch.no_grad(), torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+                image_attention = model.encode_image_attention(images)
+            batch_maps = image_attention.reshape(-1, 14, 14).float().cpu().numpy()
+
+            for attention_map in batch_maps:
+                attention_map, salient_mask = get_salient_attention(attention_map)
+                if plot:
+                    i = len(attention_maps)
+                    futures.append(executor.submit(save_attention_map, Image.open(impaths[i]), attention_map, salient_mask,
+                                                   model.visual.input_resolution, names[i]))
+                attention_maps.append(attention_map)
+                salient_masks.append(salient_mask)
+        # Propagate errors raised while saving
+        for future in futures:
+            future.result()
+    return attention_maps, salient_masks
+
+
 if __name__ == "__main__":
+    # Numba kernels of umap-learn / pynndescent are memory-bandwidth bound: one thread per physical core
+    # (set here, before umap / pynndescent are imported, so that importing this module leaves the environment untouched)
+    try:
+        import psutil
+        os.environ.setdefault('NUMBA_NUM_THREADS', str(psutil.cpu_count(logical=False) or os.cpu_count()))
+    except ImportError:
+        pass
+
     # Load data
     features, targets, predictions, similarities, string_targets, classnames = get_data()
 
@@ -482,11 +798,10 @@ if __name__ == "__main__":
             print(f"Silhouette Score : T {silhouette_complete:.4f}, C {silhouette_correct:.4f}, W {silhouette_wrongs:.4f}")
             myfile.write(f"Silhouette Score : T {silhouette_complete:.4f}, C {silhouette_correct:.4f}, W {silhouette_wrongs:.4f}\n")
 
-            ari = compute_ari(targets, predictions)
+            ari, homogeneity, completeness, v_measure = compute_all_cluster_metrics(targets, predictions)
             print(f"ARI : {ari:.4f}")
             myfile.write(f"ARI : {ari:.4f}\n")
 
-            homogeneity, completeness, v_measure = compute_clustering_metrics(targets, predictions)
             print(f"Homogeneity : {homogeneity:.4f}, Completeness : {completeness:.4f}, V-measure : {v_measure:.4f}")
             myfile.write(f"Homogeneity : {homogeneity:.4f}, Completeness : {completeness:.4f}, V-measure : {v_measure:.4f}\n")
 
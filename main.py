@@ -34,6 +34,10 @@ def get_arguments():
     parser.add_argument('--lr', default=2e-4, type=float)
     parser.add_argument('--n_iters', default=8, type=int)
     parser.add_argument('--batch_size', default=24, type=int)
+    parser.add_argument('--compile', default=False, action='store_true', help='compile the image encoder and Meta-Adapter with torch.compile (reduce-overhead)')
+    parser.add_argument('--accum_steps', default=1, type=int, help='number of batches to accumulate gradients over before each optimizer step')
+    parser.add_argument('--val_every', default=1, type=int, help='validate (and keep the best model) at the end of an epoch once at least N iterations passed since the last validation')
+    parser.add_argument('--refresh_every', default=1, type=int, help='re-encode the class features every N training steps (reused, without gradient, in between)')
     # LoRA arguments
     parser.add_argument('--position', type=str, default='all', choices=['bottom', 'mid', 'up', 'half-up', 'half-bottom', 'all', 'top3'], help='where to put the LoRA modules')
     parser.add_argument('--encoder', type=str, choices=['text', 'vision', 'both'], default='both')
@@ -92,20 +96,29 @@ def main():
             transforms.ToTensor(),
             transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073), std=(0.26862954, 0.26130258, 0.27577711))
         ])
-        train_loader = build_data_loader(data_source=dataset.train_x, batch_size=args.batch_size, tfm=train_tranform, is_train=True, shuffle=True, num_workers=8)
+        # CUDA graphs need static shapes: drop the last incomplete batch when compiling,
+        # unless the training set is smaller than one batch (low-shot runs would have no batch left)
+        drop_last = args.compile and len(dataset.train_x) >= args.batch_size
+        train_loader = build_data_loader(data_source=dataset.train_x, batch_size=args.batch_size, tfm=train_tranform, is_train=True, shuffle=True, num_workers=8, drop_last=drop_last)
 
     # Prepare model
     model = FewShotClip(args, clip_model).cuda()
     model._params_to_float()
     meta_query, meta_key = None, None
+    loaded_keys = ()
     # Load model checkpoint if specified
     if args.load_ckpt is not None:
         checkpoint = torch.load(args.load_ckpt, weights_only=True)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        model.load_trained_state_dict(checkpoint['model_state_dict'])
+        loaded_keys = checkpoint['model_state_dict'].keys()
         if args.enable_MetaAdapter :
             meta_query = checkpoint['meta_query'].cuda()
             meta_key = checkpoint['meta_key'].cuda()
+    # after loading, so trained tensors frozen in eval-only runs (BitFit biases) are not rounded
+    model._frozen_params_to_autocast_dtype(skip=loaded_keys)
     print("MODEL SIZE => ", sum(p.numel() for p in model.parameters() if p.requires_grad))
+    if args.compile:
+        model._compile()
 
     # Prepare class features according to modality
     model.eval()
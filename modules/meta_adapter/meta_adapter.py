@@ -1,4 +1,5 @@
 import os
+import math
 import random
 import argparse
 import yaml
@@ -56,8 +57,8 @@ class MetaAdapter(nn.Module):
         key = key.reshape(B, K + 1, 1, -1).permute(0, 2, 1, 3)
         value = value.reshape(B, K + 1, 1, -1).permute(0, 2, 1, 3)
 
-        attn_weight = (query @ key.transpose(-1, -2) / torch.sqrt(torch.tensor(self.dim, dtype=torch.float))).softmax(-1)
-        attn = attn_weight @ value
+        # fused softmax(QK^T / sqrt(dim)) V, the attention weights are not materialized
+        attn = F.scaled_dot_product_attention(query, key, value.to(query.dtype), scale=1 / math.sqrt(self.dim))
 
         alpha = torch.nn.functional.sigmoid(self.alpha_proj(res).reshape(B, -1, 1, 1))
         attn = (alpha * attn).squeeze()
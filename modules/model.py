@@ -4,6 +4,7 @@ from torch import nn
 
 from .lora.loralib import apply_lora
 from .clip import *
+from .utils import AUTOCAST_DTYPE
 from .meta_adapter.meta_adapter import MetaAdapter
 
 def get_text_target_features(model, dataset):
@@ -12,10 +13,10 @@ def get_text_target_features(model, dataset):
     """
     template = dataset.template[0] 
     texts = [template.format(classname.replace('_', ' ')) for classname in dataset.classnames]
-    with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+    with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
         texts = clip.tokenize(texts).cuda()
         text_embedding = model.encode_text(texts)
-        text_features = text_embedding/text_embedding.norm(dim=-1, keepdim=True)
+        text_features = F.normalize(text_embedding, dim=-1)
     return text_features
 
 def get_vision_target_features(model, loader):
@@ -25,13 +26,13 @@ def get_vision_target_features(model, loader):
     # Data augmentation for the cache model
     features_list = []
     for i, (images, target, breaking_img1, breaking_img2) in enumerate(loader):
-        images = images.cuda()
-        with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+        images = images.cuda(non_blocking=True)
+        with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
             image_features = model.encode_image(images)
-            features_list.append(image_features)
-    #with torch.amp.autocast(device_type="cuda", dtype=dtype_autocast):
+            # clone: when compiled with CUDA graphs the next encoder call overwrites this output buffer
+            features_list.append(image_features.clone())
     vision_features = torch.cat(features_list, dim=0)    
-    normalized_vision_features = vision_features/vision_features.norm(dim=-1, keepdim=True)
+    normalized_vision_features = F.normalize(vision_features, dim=-1)
 
     return normalized_vision_features
 
@@ -75,9 +76,48 @@ class FewShotClip(nn.Module):
             self.meta_adapter = MetaAdapter(dim=512, dropout_prob=args.dropout_rate_MetaAdapter).to(self.clip_model.dtype)
             print("Adding Meta-Adapter to CLIP model.")
 
+    def _compile(self):
+        """
+        Compile the image encoder and Meta-Adapter with TorchInductor in reduce-overhead mode (CUDA graphs).
+        Only the forward functions are replaced, so state_dict keys are unchanged.
+        """
+        print("Compiling image encoder with torch.compile (first batches include compilation time).")
+        self.encode_image = torch.compile(self.encode_image, mode="reduce-overhead", fullgraph=False)
+        if hasattr(self, 'meta_adapter'):
+            self.meta_adapter.forward = torch.compile(self.meta_adapter.forward, mode="reduce-overhead", fullgraph=False)
+
+    def load_trained_state_dict(self, state_dict):
+        """
+        Load a checkpoint holding only the trained tensors (LoRA / BitFit / Meta-Adapter).
+        Frozen CLIP weights may be missing, but every trainable parameter must be provided and every key must exist in the model,
+        otherwise a checkpoint built for another configuration would silently leave the model as plain CLIP.
+        Loaded parameters keep the checkpoint dtype (e.g. float32 BitFit biases that are frozen in eval-only runs).
+        """
+        params = dict(self.named_parameters(remove_duplicate=False))
+        for n, v in state_dict.items():
+            if n in params and params[n].dtype != v.dtype:
+                params[n].data = params[n].data.to(v.dtype)
+        m, u = self.load_state_dict(state_dict, strict=False)
+        trainable = {n for n, p in self.named_parameters() if p.requires_grad}
+        missing_trainable = [k for k in m if k in trainable]
+        if len(u) > 0 or len(missing_trainable) > 0:
+            raise RuntimeError(f"Checkpoint does not match the model configuration.\n"
+                               f"missing trainable keys: {missing_trainable}\nunexpected keys: {u}")
+
     def _params_to_float(self):
         for param in self.parameters():
             if param.requires_grad:
                 param.data = param.data.float()
+
+    def _frozen_params_to_autocast_dtype(self, skip=()):
+        """
+        Store the frozen half precision CLIP weights in the autocast dtype, so autocast does not re-cast them every forward.
+        No-op when autocasting to float16. LoRA base weights (float32, merged in place), LayerNorms and the parameters
+        named in skip (loaded from a checkpoint, call this after loading) are left as they are.
+        """
+        skip = set(skip)
+        for n, param in self.named_parameters():
+            if n not in skip and not param.requires_grad and param.dtype == torch.float16:
+                param.data = param.data.to(AUTOCAST_DTYPE)
         
         
\ No newline at end of file
@@ -5,7 +5,6 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-import copy
 
 # Local Modules
 from .utils import *
@@ -23,13 +22,13 @@ from .model import get_text_target_features, get_vision_target_features
 
 def preserving_breaking_loss(args, model, logit_scale, preserving_loss, breaking_img1, breaking_img2, feature_bank):
     
-    breaking_img1, breaking_img2 = breaking_img1.cuda(), breaking_img2.cuda()
+    breaking_img1, breaking_img2 = breaking_img1.cuda(non_blocking=True), breaking_img2.cuda(non_blocking=True)
 
-    with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+    with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
         breaking_features_1 = model.encode_image(breaking_img1)
         breaking_features_2 = model.encode_image(breaking_img2)
-    breaking_features_1 = breaking_features_1/breaking_features_1.norm(dim=-1, keepdim=True)
-    breaking_features_2 = breaking_features_2/breaking_features_2.norm(dim=-1, keepdim=True)
+    breaking_features_1 = F.normalize(breaking_features_1, dim=-1)
+    breaking_features_2 = F.normalize(breaking_features_2, dim=-1)
 
     if len(feature_bank) > 0:
         compared_features = torch.cat(feature_bank, dim=0).cuda()
@@ -45,6 +44,23 @@ def preserving_breaking_loss(args, model, logit_scale, preserving_loss, breaking
     return loss, breaking_features_1
 
 
+def update_meta_key(meta_key, target, image_features):
+    """
+    Push the batch features in front of the support keys of their class (in place), dropping the oldest ones.
+    Same result as inserting the samples one at a time, so with repeated labels the last sample ends up in slot 0.
+    """
+    n_classes, n_keys, dim = meta_key.shape
+    # slot of each sample = number of later samples of the same class
+    rank = torch.triu(target[:, None] == target[None, :], diagonal=1).sum(dim=1)
+    # shift the old keys of each class right by its number of new samples
+    counts = torch.bincount(target, minlength=n_classes)
+    shift_idx = (torch.arange(n_keys, device=meta_key.device) - counts[:, None]).clamp(min=0)
+    meta_key.copy_(torch.gather(meta_key, 1, shift_idx[:, :, None].expand(-1, -1, dim)))
+    # write the new features (samples pushed out by later ones of the same class are dropped)
+    keep = rank < n_keys
+    meta_key[target[keep], rank[keep]] = image_features[keep].to(meta_key.dtype)
+
+
 def eval_and_get_data(args, model, logit_scale, loader, target_features, support_img_loader=None, meta_query=None, meta_key=None):
     """
     Runs evaluation of FewShotClip model on the given loader.
@@ -61,59 +77,84 @@ def eval_and_get_data(args, model, logit_scale, loader, target_features, support
     if args.enable_MetaAdapter and (meta_key is None or meta_query is None) and support_img_loader is None:
         raise ValueError("Neither support_img_loader nor (meta_key and meta_query) provided. Please provide one of them.")
 
-    acc = 0.
+    correct = 0
     tot_samples = 0
-    all_images = []
-    all_targets = []
-    all_predictions = []
-    all_similarities = []
-    all_features = []
-    # Evaluation mode
+    n_samples = len(loader.dataset)
+    # Images go to a regular host array through a single batch-sized pinned staging buffer
+    all_images = None
+    staging_images = None
+    staged_batch = None
+    staging_copied = torch.cuda.Event()
+    # Evaluation mode (inference_mode: no autograd recording, no version counters)
     model.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         # Extract Query - Key pairs for Meta-Adapter (if enabled and key/query not provided)
         if args.enable_MetaAdapter and (meta_query is None or meta_key is None) :
             support_features = get_vision_target_features(model, support_img_loader) # Support features
             meta_query = target_features # Category embeddings
             meta_key = support_features.reshape(meta_query.shape[0], -1, meta_query.shape[1]) # Support embedding
 
+        # Class features are fixed during evaluation: adapt them once and fold logit_scale into the matmul operand
+        if args.enable_MetaAdapter:
+            with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
+                meta_adaptation = model.meta_adapter(meta_query, meta_key, meta_key)
+            scaled_targets = (logit_scale * meta_adaptation).t().contiguous().to(AUTOCAST_DTYPE)
+        else :
+            # directly get similarity scores with class features
+            scaled_targets = (logit_scale * target_features).t().contiguous().to(AUTOCAST_DTYPE)
+
+        # Output buffers sized by the dataset, each batch is written into its slice
+        all_targets = torch.empty(n_samples, dtype=torch.long, device='cuda')
+        all_predictions = torch.empty(n_samples, dtype=torch.long, device='cuda')
+        all_features = torch.empty((n_samples, scaled_targets.shape[0]), dtype=torch.float32, device='cuda')
+        all_similarities = torch.empty((n_samples, scaled_targets.shape[1]), dtype=torch.float32, device='cuda')
+
         # Evaluation loop
         for i, (images, target, breaking_img1, breaking_img2) in enumerate(loader):
-            images, target = images.cuda(), target.cuda()
-            with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+            images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
+            with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
                 image_features = model.encode_image(images)
-                image_features = image_features/image_features.norm(dim=-1, keepdim=True)
+                # in place: nothing is recorded for backward under inference_mode
+                image_features /= image_features.norm(dim=-1, keepdim=True)
             
             # calculate cosine similarity and predictions
-            if args.enable_MetaAdapter:
-                with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
-                    meta_adaptation = model.meta_adapter(meta_query, meta_key, meta_key)
-                cosine_similarity = logit_scale * image_features @ meta_adaptation.t()
-            else :
-                # directly get similarity scores with class features
-                cosine_similarity = logit_scale * image_features @ target_features.t()
+            cosine_similarity = (image_features.to(AUTOCAST_DTYPE) @ scaled_targets).float()
 
             # get predictions
             pred = cosine_similarity.argmax(dim=-1)
-            # update accuracy
-            acc += cls_acc(cosine_similarity, target) * len(cosine_similarity)
-            tot_samples += len(cosine_similarity)
+            # update accuracy (counted on device, read back once at the end)
+            correct += (pred == target).sum()
             
-            # collect data 
-            all_images.extend(images.cpu().numpy())
-            all_targets.extend(target.cpu().numpy())
-            all_predictions.extend(pred.cpu().numpy())
-            all_features.extend(image_features.cpu().numpy() if not args.enable_MetaAdapter else meta_adaptation.cpu().numpy())
-            all_similarities.extend(cosine_similarity.cpu().numpy())
+            # collect data (kept on device, images are copied asynchronously through the pinned staging buffer)
+            batch = slice(tot_samples, tot_samples + len(images))
+            if all_images is None:
+                all_images = torch.empty((n_samples, *images.shape[1:]), dtype=torch.float16)
+                staging_images = torch.empty((loader.batch_size or len(images), *images.shape[1:]), dtype=torch.float16, pin_memory=True)
+            if staged_batch is not None:
+                # the previous batch must have left the staging buffer before it is overwritten
+                staging_copied.synchronize()
+                all_images[staged_batch].copy_(staging_images[:staged_batch.stop - staged_batch.start])
+            staging_images[:len(images)].copy_(images.half(), non_blocking=True)
+            staging_copied.record()
+            staged_batch = batch
+            all_targets[batch] = target
+            all_predictions[batch] = pred
+            all_features[batch] = image_features
+            all_similarities[batch] = cosine_similarity
+            tot_samples += len(images)
+
+        # flush the last staged batch (all_images is an inference tensor, so it is only written in here)
+        torch.cuda.synchronize()
+        all_images[staged_batch].copy_(staging_images[:staged_batch.stop - staged_batch.start])
      
     # calculate final accuracy       
-    acc /= tot_samples
-    # convert data to numpy arrays
-    images = np.array(all_images)
-    targets = np.array(all_targets)
-    predictions = np.array(all_predictions)
-    features = np.array(all_features)
-    similarities = np.array(all_similarities)
+    acc = 100 * float(correct) / tot_samples
+    # convert data to numpy arrays with a single device -> host transfer each
+    images = all_images.numpy()
+    targets = all_targets.cpu().numpy()
+    predictions = all_predictions.cpu().numpy()
+    features = all_features.cpu().numpy()
+    similarities = all_similarities.cpu().numpy()
     
     return acc, images, targets, predictions, features, similarities
 
@@ -128,39 +169,43 @@ def eval_model(args, model, logit_scale, loader, target_features, support_img_lo
     if args.enable_MetaAdapter and (meta_key is None or meta_query is None) and support_img_loader is None:
         raise ValueError("Neither support_img_loader nor (meta_key and meta_query) provided. Please provide one of them.")
 
-    acc = 0.
+    correct = 0
     tot_samples = 0
-    # Evaluation mode
+    # Evaluation mode (inference_mode: no autograd recording, no version counters)
     model.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         # Extract Query - Key pairs for Meta-Adapter (if enabled and key/query not provided)
         if args.enable_MetaAdapter and (meta_query is None or meta_key is None) :
             support_features = get_vision_target_features(model, support_img_loader) # Support features
             meta_query = target_features # Category embeddings
             meta_key = support_features.reshape(meta_query.shape[0], -1, meta_query.shape[1]) # Support embedding
 
+        # Class features are fixed during evaluation: adapt them once and fold logit_scale into the matmul operand
+        if args.enable_MetaAdapter:
+            with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
+                meta_adaptation = model.meta_adapter(meta_query, meta_key, meta_key)
+            scaled_targets = (logit_scale * meta_adaptation).t().contiguous().to(AUTOCAST_DTYPE)
+        else :
+            # directly get similarity scores with class features
+            scaled_targets = (logit_scale * target_features).t().contiguous().to(AUTOCAST_DTYPE)
+
         # Evaluation loop
         for i, (images, target, breaking_img1, breaking_img2) in enumerate(loader):
-            images, target = images.cuda(), target.cuda()
-            with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+            images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
+            with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
                 image_features = model.encode_image(images)
-                image_features = image_features/image_features.norm(dim=-1, keepdim=True)
+                # in place: nothing is recorded for backward under inference_mode
+                image_features /= image_features.norm(dim=-1, keepdim=True)
             
             # calculate cosine similarity and predictions
-            if args.enable_MetaAdapter:
-                with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
-                    meta_adaptation = model.meta_adapter(meta_query, meta_key, meta_key)
-                cosine_similarity = logit_scale * image_features @ meta_adaptation.t()
-            else :
-                # directly get similarity scores with class features
-                cosine_similarity = logit_scale * image_features @ target_features.t()
+            cosine_similarity = (image_features.to(AUTOCAST_DTYPE) @ scaled_targets).float()
 
-            # update accuracy
-            acc += cls_acc(cosine_similarity, target) * len(cosine_similarity)
+            # update accuracy (counted on device, read back once at the end)
+            correct += (cosine_similarity.argmax(dim=-1) == target).sum()
             tot_samples += len(cosine_similarity)
             
     # calculate final accuracy       
-    acc /= tot_samples
+    acc = 100 * float(correct) / tot_samples
 
     return acc
 
@@ -182,12 +227,24 @@ def train_model(args, model, logit_scale, dataset, train_loader, val_loader, tes
 
     # Set up optimizer and scheduler
     total_iters = args.n_iters * args.shots
-    optimizer = torch.optim.AdamW(model.parameters(), weight_decay=1e-2, betas=(0.9, 0.999), lr=args.lr)
-    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, total_iters, eta_min=1e-6)
+    # Only LoRA / BitFit / Meta-Adapter parameters are trainable, the optimizer state is built for those alone
+    trainable_params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.AdamW(trainable_params, weight_decay=1e-2, betas=(0.9, 0.999), lr=args.lr, fused=True)
+    # with gradient accumulation the optimizer (and scheduler) step once every args.accum_steps iterations
+    total_steps = (total_iters + args.accum_steps - 1) // args.accum_steps
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, total_steps, eta_min=1e-6)
 
     # training model
-    scaler = torch.cuda.amp.GradScaler()
+    # Loss scaling is only needed for float16, with bfloat16 the scaler is a pass-through
+    scaler = torch.amp.GradScaler('cuda', enabled=(AUTOCAST_DTYPE == torch.float16))
     count_iters = 0
+    last_val_iter = 0
+    # Label features only change during training if the adapted encoder produces them
+    refresh_targets = (args.enable_lora and task_type == 'image2text' and (args.encoder == 'text' or args.encoder == 'both')) or \
+                      (args.enable_lora and task_type == 'image2image' and (args.encoder == 'vision' or args.encoder == 'both')) or \
+                      (args.enable_BitFit)
+    # logit_scale is folded into the class features (autocast dtype, contiguous), the per-step logits are a single matmul
+    scaled_targets = (logit_scale * target_features).T.contiguous().to(AUTOCAST_DTYPE)
     best_acc = -1
     best_weights = {}
     feature_bank = []
@@ -199,54 +256,64 @@ def train_model(args, model, logit_scale, dataset, train_loader, val_loader, tes
         TRAINING
         '''
         model.train()
-        acc_train = 0
+        correct_train = 0
         tot_samples = 0
         loss_epoch = 0.
         for i, (images, target, breaking_img1, breaking_img2) in enumerate(tqdm(train_loader, desc=f'Training')):
+            if args.compile:
+                # New training step for CUDA graphs: outputs of the previous step may be overwritten
+                torch.compiler.cudagraph_mark_step_begin()
             # Load data on GPU
-            images, target = images.cuda(), target.cuda()
-            # Load Label features
-            if  (args.enable_lora and task_type == 'image2text' and (args.encoder == 'text' or args.encoder == 'both')) or \
-                (args.enable_lora and task_type == 'image2image' and (args.encoder == 'vision' or args.encoder == 'both')) or \
-                (args.enable_BitFit) :
-                target_features = get_text_target_features(model, dataset) if task_type == 'image2text' else get_vision_target_features(model, target_loader)
+            images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
+            # Load Label features (re-encoded every args.refresh_every steps, detached copy reused in between)
+            if refresh_targets:
+                if count_iters % args.refresh_every == 0:
+                    target_features = get_text_target_features(model, dataset) if task_type == 'image2text' else get_vision_target_features(model, target_loader)
+                    scaled_targets = (logit_scale * target_features).T.contiguous().to(AUTOCAST_DTYPE)
+                else:
+                    target_features = target_features.detach()
+                    scaled_targets = scaled_targets.detach()
             # Forward the batch
             if args.encoder == 'vision' or args.encoder == 'both':
-                with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+                with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
                     image_encoding = model.encode_image(images)
-                    image_features = image_encoding/image_encoding.norm(dim=-1, keepdim=True)
+                    # out of place: autograd needs image_encoding for the normalization backward
+                    image_features = F.normalize(image_encoding, dim=-1)
 
             if args.enable_MetaAdapter:
                 # Forward through Meta-Adapter
-                with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+                with torch.amp.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE):
                     meta_adaptation = model.meta_adapter(meta_query, meta_key, meta_key)
                 cosine_similarity = logit_scale * image_features @ meta_adaptation.T
             else :
                 # directly get similarity scores with class features
-                cosine_similarity = logit_scale * image_features @ target_features.T
+                cosine_similarity = (image_features.to(AUTOCAST_DTYPE) @ scaled_targets).float()
             
             loss = F.cross_entropy(cosine_similarity, target)
             if args.enable_breaking_loss and args.dataset == 'circuits' :
                 loss, aug_features = preserving_breaking_loss(args, model, logit_scale, loss, breaking_img1, breaking_img2, feature_bank)
 
-            acc_train += cls_acc(cosine_similarity, target) * target.shape[0]
-            loss_epoch += loss.item() * target.shape[0]
+            # accuracy and loss are accumulated on device, no host sync per step
+            correct_train += (cosine_similarity.argmax(dim=-1) == target).sum()
+            loss_epoch += loss.detach() * target.shape[0]
             tot_samples += target.shape[0]
             
-            optimizer.zero_grad()
-            scaler.scale(loss).backward(retain_graph=True)
-            scaler.step(optimizer)
-            scaler.update()
-            scheduler.step()
+            # gradients are summed over args.accum_steps micro-batches, the loss is averaged accordingly
+            scaler.scale(loss / args.accum_steps).backward()
+            if (count_iters + 1) % args.accum_steps == 0 or count_iters + 1 == total_iters:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                scheduler.step()
             
             # update cache_keys
             if args.enable_MetaAdapter :
                 with torch.no_grad():
-                    for tar, feat in zip(target, image_features):
-                        meta_key[tar] = torch.cat([feat[None, :], meta_key[tar][:meta_key.shape[1] - 1]], dim=0)
+                    update_meta_key(meta_key, target, image_features)
 
             if args.enable_breaking_loss and args.dataset == 'circuits' :
-                feature_bank.append(aug_features.detach())
+                # clone: the encoder output buffer is reused by the next step when compiled with CUDA graphs
+                feature_bank.append(aug_features.detach().clone())
                 if len(feature_bank) > args.bank_size:
                     feature_bank = feature_bank[-args.bank_size:]
 
@@ -257,21 +324,32 @@ def train_model(args, model, logit_scale, dataset, train_loader, val_loader, tes
         INFERENCE
         '''
         if count_iters < total_iters:
-            acc_train /= tot_samples
-            loss_epoch /= tot_samples
+            acc_train = 100 * float(correct_train) / tot_samples
+            loss_epoch = float(loss_epoch) / tot_samples
             current_lr = scheduler.get_last_lr()[0]
             print(f"LR: {current_lr:.6f}, Acc: {acc_train:.4f}, Loss: {loss_epoch:.4f}")
 
+        # Validate at the end of the epoch once at least args.val_every iterations have passed (always after the last one)
+        if count_iters - last_val_iter < args.val_every and count_iters < total_iters:
+            continue
+        last_val_iter = count_iters
+        if refresh_targets:
+            # class features matching the current weights (the training ones predate the last optimizer step)
+            model.eval()
+            with torch.no_grad():
+                target_features = get_text_target_features(model, dataset) if task_type == 'image2text' else get_vision_target_features(model, target_loader)
+            scaled_targets = (logit_scale * target_features).T.contiguous().to(AUTOCAST_DTYPE)
         acc_val = eval_model(args, model, logit_scale, test_loader, target_features, meta_query=meta_query, meta_key=meta_key)
         print(f"**** Validation accuracy: {acc_val:.4f}. ****")
         # Save best model (maximizing validation accuracy)
         if acc_val > best_acc:
             best_acc = acc_val
             print(f"Saving model at iteration [{count_iters}]")
+            # only the trained tensors (LoRA / BitFit / Meta-Adapter) change, the frozen CLIP weights are not copied
             save_dict = {
-                'model_state_dict': copy.deepcopy(model.state_dict()),
-                'meta_query': meta_query if args.enable_MetaAdapter else None,
-                'meta_key': meta_key if args.enable_MetaAdapter else None,
+                'model_state_dict': {n: p.detach().to('cpu', copy=True) for n, p in model.named_parameters() if p.requires_grad},
+                'meta_query': meta_query.clone() if args.enable_MetaAdapter else None,
+                'meta_key': meta_key.clone() if args.enable_MetaAdapter else None,
             }
             if args.save_path != None:
                 full_path = os.path.join(args.save_path, str(args.filename) + '.pt')
@@ -283,7 +361,9 @@ def train_model(args, model, logit_scale, dataset, train_loader, val_loader, tes
     '''
     FINAL INFERENCE
     '''
-    model.load_state_dict(save_dict['model_state_dict'])
+    # unmerge the current LoRA weights before loading the best ones, eval() merges them back
+    model.train()
+    model.load_trained_state_dict(save_dict['model_state_dict'])
     meta_query = save_dict['meta_query']
     meta_key = save_dict['meta_key']
     model.eval()
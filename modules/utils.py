@@ -12,6 +12,9 @@ from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 from skimage.transform import resize
 import numpy as np
 
+# Mixed precision dtype: bfloat16 on GPUs that support it (no loss scaling needed), float16 otherwise
+AUTOCAST_DTYPE = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
+
 def cls_acc(output, target, topk=1):
     pred = output.topk(topk, 1, True, True)[1].t()
     correct = pred.eq(target.view(1, -1).expand_as(pred))
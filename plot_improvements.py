@@ -10,7 +10,7 @@ import modules.clip as clip
 from modules.runner import train_model, eval_model, eval_and_get_data
 from modules.utils import *
 from modules.model import FewShotClip, get_text_target_features, get_vision_target_features
-from failure_case_analysis import plot_topk_images_for_class, plot_topk_images, plot_attention_map_enhance
+from failure_case_analysis import plot_topk_images_for_class, plot_topk_images, plot_attention_map_enhance, resize_heatmap, get_display_range, prepare_display_image
 # plot modules
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
@@ -63,9 +63,8 @@ def plot_improvements(images_1, targets_1, targets_2, predictions_1, predictions
     print(f"Found {len(improvement_indices)} improved images.")
     print(f"Selected indices: {top_indices}")
 
-    # Normalize images for display
-    images_display = np.transpose(images_1, (0, 2, 3, 1))
-    images_display = (images_display - images_display.min()) / (images_display.max() - images_display.min())
+    # Images are normalized for display only once selected
+    value_range = get_display_range(images_1)
     
     # Prepare plot
     num_rows = len(top_indices)
@@ -86,21 +85,21 @@ def plot_improvements(images_1, targets_1, targets_2, predictions_1, predictions
         attention_map_2, salient_mask_2 = plot_attention_map_enhance(dataset[idx].impath, preprocess, model_2, idx, False)
         attention_diff = attention_map_2 - attention_map_1
 
-        h, w, _ = images_display[idx].shape # for resizing attention maps
+        image_display = prepare_display_image(images_1[idx], value_range)
+        h, w, _ = image_display.shape # for resizing attention maps
 
         # Plot the original image
         ax_img = fig.add_subplot(gs[i, 0])
-        ax_img.imshow(images_display[idx])
+        ax_img.imshow(image_display)
         ax_img.axis('off')
         ax_img.set_title(f"Original Image\nTrue: {true_label}\nDelta Marginal Entropy: {delta:.5f}")
         
         # Plot the attention map 1
         salient_heatmap = np.zeros_like(attention_map_1)
         salient_heatmap[salient_mask_1] = attention_map_1[salient_mask_1]
-        salient_heatmap_resized = resize(salient_heatmap, (h, w), 
-                                        order=3, mode='constant')
+        salient_heatmap_resized = resize_heatmap(salient_heatmap, h, w)
         ax_attn = fig.add_subplot(gs[i, 1])
-        ax_attn.imshow(images_display[idx])
+        ax_attn.imshow(image_display)
         ax_attn.imshow(cmap(salient_heatmap_resized), alpha=0.3, cmap=cmap)
         #ax_attn.imshow(attention_map_1)
         ax_attn.axis('off')
@@ -109,19 +108,18 @@ def plot_improvements(images_1, targets_1, targets_2, predictions_1, predictions
         # Plot the attention map 2 
         salient_heatmap = np.zeros_like(attention_map_2)
         salient_heatmap[salient_mask_2] = attention_map_2[salient_mask_2]
-        salient_heatmap_resized = resize(salient_heatmap, (h, w), 
-                                        order=3, mode='constant')
+        salient_heatmap_resized = resize_heatmap(salient_heatmap, h, w)
         ax_attn = fig.add_subplot(gs[i, 2])
-        ax_attn.imshow(images_display[idx])
+        ax_attn.imshow(image_display)
         ax_attn.imshow(cmap(salient_heatmap_resized), alpha=0.3, cmap=cmap)
         #ax_attn.imshow(attention_map_2)
         ax_attn.axis('off')
         ax_attn.set_title(f"Attention Map After\nPred2: {pred_label_2}")
 
         # Plot the difference in attention maps
-        diff_resized = resize(attention_diff, (h, w), order=3, mode='constant')
+        diff_resized = resize_heatmap(attention_diff, h, w)
         ax_diff = fig.add_subplot(gs[i, 3])
-        ax_diff.imshow(images_display[idx])
+        ax_diff.imshow(image_display)
         ax_diff.imshow(cmap(diff_resized), alpha=0.3)
         ax_diff.axis('off')
         ax_diff.set_title("Attention Shift\nMap")
@@ -176,7 +174,7 @@ def main():
     # load model 1 
     if args_1.load_ckpt is not None:
         checkpoint = torch.load(args_1.load_ckpt, weights_only=True)
-        model_1.load_state_dict(checkpoint['model_state_dict'])
+        model_1.load_trained_state_dict(checkpoint['model_state_dict'])
         model_1 = model_1.float()
         if args_1.enable_MetaAdapter :
             meta_query = checkpoint['meta_query'].cuda()
@@ -185,7 +183,7 @@ def main():
     # load model 2
     if args_2.load_ckpt is not None:
         checkpoint = torch.load(args_2.load_ckpt, weights_only=True)
-        model_2.load_state_dict(checkpoint['model_state_dict'])
+        model_2.load_trained_state_dict(checkpoint['model_state_dict'])
         model_2 = model_2.float()
         if args_2.enable_MetaAdapter :
             meta_query = checkpoint['meta_query'].cuda()